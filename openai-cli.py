@@ -1,16 +1,34 @@
 #!/usr/bin/env python3
 
 import argparse
+import asyncio
+import functools
+import hashlib
+import io
+import json
 import os
 import readline
-
-from dotenv import load_dotenv
-from openai import OpenAI
-
-load_dotenv()
+import sqlite3
+import sys
+import termios
+import threading
+import time
+import uuid
 
 PROMPT = '>> '
 MULTILINE_PROMPT = ''
+FLUSH_INTERVAL = 0.016  # seconds between stdout flushes while streaming
+RENDER_QUEUE_SIZE = 64
+SENTENCE_ENDINGS = ('.', '!', '?', '\n')
+SENTENCE_MAX_CHARS = 160
+OPENAI_API_HOST = 'api.openai.com'
+CACHE_PATH = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+    'openai-cli', 'responses.db',
+)
+CACHE_MAX_ENTRIES = 1024
+HISTORY_PATH = os.path.expanduser('~/.openai_cli_history')
+HISTORY_LENGTH = 1000
 
 class TextColor:
     BLACK = '\033[30m'
@@ -27,55 +45,214 @@ class TextColor:
     UNDERLINE = '\033[4m'
     ITALIC = '\033[3m'
 
+RESET_BYTES = TextColor.RESET.encode()
+
 class ColorWriter:
+    # Escape codes are encoded once up front and written straight to the
+    # binary buffer, skipping print() and a str encode on every use
+    __slots__ = ('color_bytes',)
+
     def __init__(self, color):
-        self.color = color
+        self.color_bytes = color.encode()
 
     def __enter__(self):
-        print(self.color, end='')
+        sys.stdout.flush()
+        sys.stdout.buffer.write(self.color_bytes)
 
     def __exit__(self, *args):
-        print(TextColor.RESET, end='')
+        sys.stdout.flush()
+        sys.stdout.buffer.write(RESET_BYTES)
+        sys.stdout.buffer.flush()
+
+@functools.cache
+def get_client(base_url=None):
+    # One long-lived client for the whole process, so that warm keep-alive
+    # connections survive across turns and conversation resets. The imports
+    # live here because openai pulls in its HTTP stack, pydantic and anyio,
+    # which is a noticeable delay for --help or an immediate 'exit'.
+    from dotenv import load_dotenv
+    from openai import DEFAULT_CONNECTION_LIMITS, AsyncOpenAI, DefaultAsyncHttpxClient, Timeout
+
+    load_dotenv()
+
+    # Start from the SDK's own client so its other defaults (such as
+    # following redirects) still apply. Limits and Timeout have to come from
+    # the HTTP library that client is built on, which isn't always httpx.
+    Limits = type(DEFAULT_CONNECTION_LIMITS)
+    http_client = DefaultAsyncHttpxClient(
+        http2=True,
+        limits=Limits(
+            max_connections=DEFAULT_CONNECTION_LIMITS.max_connections,
+            max_keepalive_connections=4,
+            keepalive_expiry=300,
+        ),
+        timeout=Timeout(60.0, connect=5.0),
+    )
+    return AsyncOpenAI(base_url=base_url, http_client=http_client)
+
+async def warm_up(client):
+    # Complete the TCP and TLS handshakes before the first real request
+    try:
+        await client.models.list()
+    except Exception:
+        pass
+
+def encode_message(message):
+    return json.dumps(message, sort_keys=True, separators=(',', ':')).encode()
+
+class ResponseCache:
+    """On-disk LRU cache of assistant replies, keyed on model and messages.
+
+    The cache is only an optimization, so database errors on lookup or
+    insert are treated as a miss rather than failing the turn.
+    """
+
+    def __init__(self, path=CACHE_PATH, max_entries=CACHE_MAX_ENTRIES):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.max_entries = max_entries
+        self.db = sqlite3.connect(path)
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS responses (key BLOB PRIMARY KEY, content TEXT, ts REAL)'
+        )
+
+    def get(self, key):
+        try:
+            row = self.db.execute('SELECT content FROM responses WHERE key = ?', (key,)).fetchone()
+        except sqlite3.Error:
+            return None
+
+        if row is None:
+            return None
+
+        try:
+            with self.db:
+                self.db.execute('UPDATE responses SET ts = ? WHERE key = ?', (time.time(), key))
+        except sqlite3.Error:
+            pass
+        return row[0]
+
+    def put(self, key, content):
+        try:
+            with self.db:
+                self.db.execute(
+                    'INSERT OR REPLACE INTO responses VALUES (?, ?, ?)', (key, content, time.time())
+                )
+                self.db.execute(
+                    'DELETE FROM responses WHERE key IN '
+                    '(SELECT key FROM responses ORDER BY ts DESC LIMIT -1 OFFSET ?)',
+                    (self.max_entries,),
+                )
+        except sqlite3.Error:
+            pass
 
 class Conversation:
-    def __init__(self, stream=True, model=''):
+    def __init__(self, stream=True, model='', cache=None, base_url=None):
         self.messages = []
         self.stream = stream
         self.model = 'gpt-4o' if not model else model
-        self.client = OpenAI()
-
-    def ask(self, content):
+        self.cache = cache
+        self.base_url = base_url
+        # self.messages is only ever appended to, so every request starts
+        # with the exact bytes of the previous one. A stable key per
+        # conversation routes those requests to the same server-side prompt
+        # cache.
+        self.prompt_cache_key = uuid.uuid4().hex
+        # Running hash of the backend, the model and every message so far.
+        # Each turn's cache key only has to serialize the new message on top
+        # of it, rather than re-encoding the whole history. The base URL is
+        # included so replies from one --proxy backend aren't replayed for
+        # another.
+        seed = self.model.encode() + b'\0' + (base_url or '').encode()
+        self.history_hash = hashlib.blake2b(seed, digest_size=16)
+
+    @property
+    def client(self):
+        return get_client(self.base_url)
+
+    async def ask(self, content):
+        # Append in place rather than copying the whole history every turn,
+        # and take the message back out if the turn doesn't complete
         message = {'role': 'user', 'content': content}
-        messages = self.messages + [message]
+        self.messages.append(message)
+        turn_hash = self.history_hash.copy()
+        turn_hash.update(encode_message(message))
 
-        response = self.client.chat.completions.create(
-            messages = messages,
-            stream = self.stream,
-            model = self.model,
-        )
+        try:
+            if self.cache is not None:
+                cache_key = turn_hash.digest()
+                response_content = self.cache.get(cache_key)
+
+                if response_content is not None:
+                    yield response_content
+                    self._add_reply(response_content, turn_hash)
+                    return
+
+            # prompt_cache_key is OpenAI-specific, and strict OpenAI-compatible
+            # servers (reached through --proxy or OPENAI_BASE_URL) reject
+            # unknown fields
+            extra_body = None
+            if self.client.base_url.host == OPENAI_API_HOST:
+                extra_body = {'prompt_cache_key': self.prompt_cache_key}
+
+            response = await self.client.chat.completions.create(
+                messages = self.messages,
+                stream = self.stream,
+                model = self.model,
+                extra_body = extra_body,
+            )
+
+            if self.stream:
+                collected_messages = io.StringIO()
+                # Hand chunks on a sentence at a time (or every
+                # SENTENCE_MAX_CHARS) rather than token by token
+                sentence = []
+                sentence_length = 0
+                finish_reason = None
+
+                async for chunk in response:
+                    if chunk.choices[0].finish_reason is not None:
+                        finish_reason = chunk.choices[0].finish_reason
+
+                    chunk_message = chunk.choices[0].delta.content
+                    if chunk_message != None:
+                        collected_messages.write(chunk_message)
+                        sentence.append(chunk_message)
+                        sentence_length += len(chunk_message)
+
+                        if (chunk_message.endswith(SENTENCE_ENDINGS)
+                                or sentence_length > SENTENCE_MAX_CHARS):
+                            yield ''.join(sentence)
+                            sentence.clear()
+                            sentence_length = 0
+
+                if sentence:
+                    yield ''.join(sentence)
+
+                response_content = collected_messages.getvalue()
+            else:
+                response_content = response.choices[0].message.content
+                finish_reason = response.choices[0].finish_reason
 
-        if self.stream:
-            collected_messages = []
+                if finish_reason != 'stop':
+                    raise Exception(f'Unexpected finish reason: {finish_reason}')
 
-            for chunk in response:
-                chunk_message = chunk.choices[0].delta.content
-                if chunk_message != None:
-                    collected_messages.append(chunk_message)
-                    yield chunk_message
+                yield response_content
+        except BaseException:
+            self.messages.pop()
+            raise
 
-            response_content = ''.join(collected_messages)
-            response_message = {'role': 'assistant', 'content': response_content}
-            self.messages.extend([message, response_message])
-        else:
-            response_message = response.choices[0].message
-            response_content = response_message.content
-            finish_reason = response.choices[0].finish_reason
+        self._add_reply(response_content, turn_hash)
 
-            if finish_reason != 'stop':
-                raise Exception(f'Unexpected finish reason: {finish_reason}')
+        # Don't replay a truncated or filtered reply for every identical
+        # conversation
+        if self.cache is not None and finish_reason == 'stop':
+            self.cache.put(cache_key, response_content)
 
-            yield response_content
-            self.messages.extend([message, response_message])
+    def _add_reply(self, content, turn_hash):
+        response_message = {'role': 'assistant', 'content': content}
+        self.messages.append(response_message)
+        turn_hash.update(encode_message(response_message))
+        self.history_hash = turn_hash
 
 def get_multi_input():
     with ColorWriter(TextColor.GREEN):
@@ -101,11 +278,180 @@ def get_input():
 
     return query
 
+async def run_in_thread(func, *args):
+    # A daemon thread rather than the loop's executor, so that a blocked
+    # input() call cannot keep the process alive after Ctrl-C
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def resolve(setter, value):
+        if not future.done():
+            setter(value)
+
+    def target():
+        try:
+            result = func(*args)
+        except BaseException as e:
+            loop.call_soon_threadsafe(resolve, future.set_exception, e)
+        else:
+            loop.call_soon_threadsafe(resolve, future.set_result, result)
+
+    threading.Thread(target=target, daemon=True).start()
+    return await future
+
+# Whether prompts are written to HISTORY_PATH. Like the response cache, the
+# history file is optional: if it can't be read or written, the session
+# carries on with in-memory history only.
+save_history_enabled = False
+
+def load_history():
+    global save_history_enabled
+
+    # With a length set, append_history_file() also truncates the file to
+    # it, so the file stays bounded instead of growing forever
+    readline.set_history_length(HISTORY_LENGTH)
+
+    try:
+        try:
+            readline.read_history_file(HISTORY_PATH)
+        except FileNotFoundError:
+            # append_history_file() needs the file to exist already
+            open(HISTORY_PATH, 'wb').close()
+
+        # Trim a file that has already grown past the limit once, up front
+        if readline.get_current_history_length() > HISTORY_LENGTH:
+            readline.write_history_file(HISTORY_PATH)
+    except OSError:
+        return
+
+    save_history_enabled = True
+
+def save_history(start):
+    global save_history_enabled
+
+    if not save_history_enabled:
+        return
+
+    # Append only the lines entered since `start` instead of rewriting the
+    # whole file on every prompt
+    added = readline.get_current_history_length() - start
+    if added > 0:
+        try:
+            readline.append_history_file(added, HISTORY_PATH)
+        except OSError:
+            save_history_enabled = False
+
+async def prompt(func):
+    history_length = readline.get_current_history_length()
+    query = await run_in_thread(func)
+    save_history(history_length)
+    return query
+
+async def render(queue):
+    with ColorWriter(TextColor.WHITE):
+        # Bind the names used per chunk to locals to skip the global and
+        # attribute lookups inside the loop
+        get, empty = queue.get, queue.empty
+        write, flush = sys.stdout.write, sys.stdout.flush
+        monotonic, flush_interval = time.monotonic, FLUSH_INTERVAL
+
+        last_flush = monotonic()
+        while (msg := await get()) is not None:
+            write(msg)
+            now = monotonic()
+            # Let stdout buffer the chunks and only flush on a newline, once
+            # the queue has drained, or once FLUSH_INTERVAL has passed,
+            # instead of once per token. Flushing on an empty queue keeps
+            # text from sitting in the buffer while the server pauses.
+            if '\n' in msg or empty() or now - last_flush > flush_interval:
+                flush()
+                last_flush = now
+        print()
+        print()
+
+async def speak(conversation, query):
+    # Chunks are handed to a separate renderer task so that reading from the
+    # socket and writing to the terminal overlap
+    queue = asyncio.Queue(maxsize=RENDER_QUEUE_SIZE)
+    renderer = asyncio.create_task(render(queue))
+
+    async def hand_off(msg):
+        # Wait on the renderer as well as the put, so that a renderer that
+        # dies with a full queue raises here instead of blocking forever
+        if renderer.done():
+            renderer.result()
+
+        if not queue.full():
+            queue.put_nowait(msg)
+            return
+
+        put = asyncio.ensure_future(queue.put(msg))
+        await asyncio.wait({put, renderer}, return_when=asyncio.FIRST_COMPLETED)
+        if not put.done():
+            put.cancel()
+            renderer.result()
+
+    responses = conversation.ask(query)
+
+    try:
+        async for msg in responses:
+            await hand_off(msg)
+        await hand_off(None)
+        await renderer
+    except BaseException:
+        renderer.cancel()
+        # Close the generator now so the unanswered message is dropped from
+        # the history straight away rather than whenever it is collected
+        await responses.aclose()
+        raise
+
+async def chat(model, multi_mode, terminate, initial_query, cache, proxy):
+    conversation = Conversation(model=model, stream=True, cache=cache, base_url=proxy)
+
+    # The event loop only keeps a weak reference to tasks, so hold on to it
+    if not initial_query:
+        warm_up_task = asyncio.create_task(warm_up(conversation.client))
+
+    while True:
+        if initial_query:
+            with ColorWriter(TextColor.GREEN):
+                print(PROMPT + initial_query)
+
+            query = initial_query
+            initial_query = False
+            multi_mode = False
+
+        elif multi_mode:
+            query = await prompt(get_multi_input)
+            multi_mode = False
+
+        else:
+            query = await prompt(get_input)
+
+        if query == '':
+            continue
+
+        elif query in ('exit', 'exit()'):
+            break
+
+        elif query in ('reset', 'reset()'):
+            conversation = Conversation(model=model, cache=cache, base_url=proxy)
+            continue
+
+        elif query in ('multi', 'multi()', 'm'):
+            query = await prompt(get_multi_input)
+
+        await speak(conversation, query)
+
+        if terminate:
+            break
+
 def main():
     parser = argparse.ArgumentParser('Start a conversation with an OpenAI language model')
     parser.add_argument('-3', '--gpt3', action='store_true', help='Use GPT-3.5')
     parser.add_argument('-m', '--multi', action='store_true', help='Start the conversation in multi mode')
     parser.add_argument('-t', '--terminate', action='store_true', help='Terminate the conversation after a single question')
+    parser.add_argument('--no-cache', action='store_true', help='Always query the model, bypassing the response cache')
     parser.add_argument('--proxy', help='Route requests to an intermediary proxy server')
     parser.add_argument('initial_query', nargs='*', help='Initial query for the model')
     args = parser.parse_args()
@@ -114,54 +460,52 @@ def main():
     multi_mode = args.multi
     terminate = args.terminate
 
-    if args.proxy:
-        openai.api_base = args.proxy
-
     initial_query = ' '.join(args.initial_query)
 
-    conversation = Conversation(model=model, stream=True)
-
+    # Run without the cache rather than refusing to start if it can't be
+    # opened (unwritable cache directory, corrupt or locked database)
+    cache = None
+    if not args.no_cache:
+        try:
+            cache = ResponseCache()
+        except (OSError, sqlite3.Error):
+            cache = None
+
+    # Skip the history file entirely for one-shot and scripted runs
+    if terminate or not sys.stdin.isatty():
+        readline.set_auto_history(False)
+    else:
+        load_history()
+
+    # input() runs on a daemon thread that is abandoned mid-read on Ctrl-C,
+    # so neither readline nor the prompt's ColorWriter gets the chance to
+    # restore the terminal itself
+    tty_attrs = termios.tcgetattr(sys.stdin) if sys.stdin.isatty() else None
+
+    # uvloop is optional, but its faster socket handling helps when reading
+    # the response stream. uvloop.run() only exists from 0.18 onwards, so
+    # older versions install uvloop's event loop policy for asyncio.run().
     try:
-        while True:
-            if initial_query:
-                with ColorWriter(TextColor.GREEN):
-                    print(PROMPT + initial_query)
-
-                query = initial_query
-                initial_query = False
-                multi_mode = False
-
-            elif multi_mode:
-                query = get_multi_input()
-                multi_mode = False
-
-            else:
-                query = get_input()
-
-            if query == '':
-                continue
-
-            elif query in ('exit', 'exit()'):
-                break
-
-            elif query in ('reset', 'reset()'):
-                conversation = Conversation(model=model)
-                continue
-
-            elif query in ('multi', 'multi()', 'm'):
-                query = get_multi_input()
-
-            with ColorWriter(TextColor.WHITE):
-                for msg in conversation.ask(query):
-                    print(msg, end='')
-                print()
-                print()
-
-            if terminate:
-                break
+        import uvloop
+    except ImportError:
+        run = asyncio.run
+    else:
+        if hasattr(uvloop, 'run'):
+            run = uvloop.run
+        else:
+            uvloop.install()
+            run = asyncio.run
 
+    try:
+        run(chat(model, multi_mode, terminate, initial_query, cache, args.proxy))
     except KeyboardInterrupt:
         pass
+    finally:
+        if tty_attrs is not None:
+            termios.tcsetattr(sys.stdin, termios.TCSADRAIN, tty_attrs)
+            sys.stdout.flush()
+            sys.stdout.buffer.write(RESET_BYTES)
+            sys.stdout.buffer.flush()
 
 if __name__ == '__main__':
     main()